@@ -20,17 +20,70 @@ UPDATE oauth_access_tokens
 
 """
 
-from io import FileIO
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+from io import FileIO, StringIO
 import logging
-import json
+from operator import itemgetter
+from pathlib import Path
 import re
+from typing import Optional
 from urllib.parse import urlencode
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import configargparse
 
 
 VERSION = "1.1.0"
+BLOCK_LIST_TEMPLATE = "https://{site}/api/v1/instance/domain_blocks"
+# Number of remote block lists to fetch at the same time.
+FETCH_WORKERS = 32
+# Number of admin POSTs to have in flight against the home instance.
+APPLY_WORKERS = 8
+# Some servers publish blocks as URLs rather than bare domains.
+_SCHEME_RE = re.compile("^(https?[://]+)")
+_SEVERITY_RANK = {"noop": 0, "silence": 1, "suspend": 2}
+
+
+def _adapter(pool_maxsize: int, pool_connections: int = 1) -> HTTPAdapter:
+    """a pooled adapter that retries on rate limits and gateway errors
+
+    `pool_connections` is how many hosts get a pool kept around, and
+    `pool_maxsize` how many connections each of those pools holds.
+    """
+    return HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            # Retrying a block POST is safe: one that already went
+            # through comes back as a 422, which apply_diff skips.
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            raise_on_status=False,
+        ),
+    )
+
+
+# Shared session so that repeated calls to the same host (e.g. the
+# admin POSTs to the home instance) reuse a kept-alive connection.
+# The default adapter keeps a pool for every concurrently fetched
+# remote, rather than evicting (and closing) one host's pool for the
+# next. Each remote only gets the one GET, so one connection apiece.
+SESSION = requests.Session()
+SESSION.mount("https://", _adapter(pool_maxsize=1, pool_connections=FETCH_WORKERS))
+
+
+def _mount_home(home: str, workers: int):
+    """give the home instance its own pool, sized for `workers` threads"""
+    prefix = f"https://{home}/"
+    if prefix not in SESSION.adapters:
+        SESSION.mount(prefix, _adapter(pool_maxsize=workers))
 
 
 def config():
@@ -58,6 +111,13 @@ this will also add them to your own instance. Version {VERSION}""",
         help="dump the collected list of sites to specified file",
     )
     parser.add("--home", help="your instance url", env_var="HOME_HOST")
+    parser.add(
+        "--workers",
+        type=int,
+        default=APPLY_WORKERS,
+        env_var="WORKERS",
+        help="number of blocks to send to your instance at a time",
+    )
     parser.add(
         "--log_level",
         default="error",
@@ -70,52 +130,189 @@ this will also add them to your own instance. Version {VERSION}""",
         help="remote servers to fetch from",
         env_var="REMOTE_HOST",
     )
+    parser.add(
+        "--cache_dir",
+        env_var="CACHE_DIR",
+        help="keep fetched block lists here and only re-download changed ones",
+    )
     # parser.add("--process", help="process a JSON file")
     settings = parser.parse_args()
     return settings
 
 
+def _canonical_domain(domain: str) -> str:
+    """lowercase, punycode form of a domain, so variants compare equal"""
+    domain = domain.strip().lower().lstrip(".")
+    if not domain.isascii():
+        try:
+            domain = domain.encode("idna").decode("ascii")
+        except UnicodeError:
+            pass
+    return domain
+
+
+def _merge_one(old: dict[str, dict], item: dict, origin: str):
+    """merge a single block record into the collection
+
+    If the domain is already in the collection, the more severe block
+    is kept (a later one wins if they're equally severe).
+    """
+    domain = item.get("domain")
+    severity = item.get("severity")
+    if not domain or not severity:
+        raise Exception("data missing required elements")
+    if "*" in domain:
+        return
+    domain = _canonical_domain(_SCHEME_RE.sub("", domain) or domain)
+    existing = old.get(domain)
+    if existing and _SEVERITY_RANK.get(
+        existing.get("severity"), 0
+    ) > _SEVERITY_RANK.get(severity, 0):
+        return
+    item["domain"] = domain
+    if origin:
+        item["private_comment"] = f"from: {origin}"
+    old[domain] = item
+
+
 def merge(old: dict[str, dict], data: list[dict], origin: str) -> dict[str, dict]:
     """merge the new data set into the collection we've got so far"""
     for item in data:
-        if not item.get("domain") or not item.get("severity"):
-            raise Exception("data missing required elements")
-        if "*" in item.get("domain"):
-            continue
-        domain = re.sub("^(https?[://]+)","",item.get("domain"))
-        if domain:
-            item["domain"] = domain
-        if origin:
-            item["private_comment"] = f"from: {origin}"
-        old[item.get("domain")] = item
+        _merge_one(old, item, origin)
     return old
 
 
-def fetch(sites: list[str]) -> dict[str, dict]:
-    """fetch remote block list using the Public API"""
+def _cache_path(cache_dir: Path, site: str) -> Path:
+    """where the cached block list for `site` lives"""
+    return cache_dir / "{}.json".format(hashlib.sha1(site.encode()).hexdigest())
+
+
+def _load_cache(path: Path) -> dict:
+    """read a cached `{etag, last_modified, body}` record, if there is one"""
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logging.warning("⚠ Ignoring unreadable cache {path}: {ex}".format(path=path, ex=ex))
+        return {}
+
+
+def _save_cache(path: Path, response: requests.Response, body: list[dict]):
+    """remember the validators for this response, so we can revalidate later"""
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+    try:
+        with open(path, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {"etag": etag, "last_modified": last_modified, "body": body}
+                )
+            )
+    except OSError as ex:
+        logging.warning("⚠ Could not write cache {path}: {ex}".format(path=path, ex=ex))
+
+
+def _fetch_one(site: str, cache_dir: Optional[Path] = None) -> Optional[list[dict]]:
+    """fetch a single remote block list, or None if it isn't available
+
+    If there's a `cache_dir`, the request is made conditional on the
+    cached copy, and an unchanged (304) list is read from the cache.
+    """
+    logging.info("Fetching {site}".format(site=site))
+    url = BLOCK_LIST_TEMPLATE.format(site=site)
+    logging.debug(url)
+    headers = {}
+    cached = {}
+    if cache_dir:
+        path = _cache_path(cache_dir, site)
+        cached = _load_cache(path)
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = SESSION.get(url, headers=headers)
+    except requests.RequestException as ex:
+        logging.error("🚨{site} could not be reached: {ex}".format(site=site, ex=ex))
+        return None
+    if response.status_code == 304 and "body" in cached:
+        logging.info("{site} unchanged, using cached list".format(site=site))
+        return cached["body"]
+    if response.status_code != 200:
+        logging.error(
+            "🚨{site} not publishing block list?:{status}".format(
+                site=site, status=response.status_code))
+        return None
+    try:
+        body = orjson.loads(response.content)
+    except ValueError as ex:
+        logging.warning("⚠ {site} returned invalid JSON: {ex}".format(site=site, ex=ex))
+        return None
+    if cache_dir:
+        _save_cache(path, response, body)
+    return body
+
+
+def fetch(sites: list[str], cache_dir: Optional[str] = None) -> dict[str, dict]:
+    """fetch remote block list using the Public API
+
+    The remote sites are fetched concurrently, but merged in the order
+    given so that later sites still take precedence.
+    """
     result = {}
-    block_list_template = "https://{site}/api/v1/instance/domain_blocks"
-    for site in sites:
-        logging.info("Fetching {site}".format(site=site))
-        url = block_list_template.format(site=site)
-        logging.debug(url)
-        response = requests.get(block_list_template.format(site=site))
-        if response.status_code != 200:
-            logging.error(
-                "🚨{site} not publishing block list?:{status}".format(
-                    site=site, status=response.status_code))
-            continue
-        try:
-            result = merge(result, response.json(), site)
-        except Exception as ex:
-            logging.warning("⚠ Merge Exception: {ex}, continuing...".format(ex=ex))
-            continue
-    logging.debug("{}: {} sites".format(site, len(result)))
+    cache_path = None
+    if cache_dir:
+        cache_path = Path(cache_dir)
+        cache_path.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        blocks = executor.map(lambda site: _fetch_one(site, cache_path), sites)
+        for site, data in zip(sites, blocks):
+            if data is None:
+                continue
+            try:
+                result = merge(result, data, site)
+            except Exception as ex:
+                logging.warning("⚠ Merge Exception: {ex}, continuing...".format(ex=ex))
+                continue
+            logging.debug("{}: {} sites".format(site, len(result)))
     return result
 
 
+def _domain_trie(domains) -> dict:
+    """build a trie of the domains' labels, last label first
+
+    e.g. "a.b.c" is stored as trie["c"]["b"]["a"], with a "$" key
+    marking where a domain ends.
+    """
+    trie = {}
+    for domain in domains:
+        node = trie
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node["$"] = True
+    return trie
+
+
+def _covered_by(trie: dict, domain: str) -> bool:
+    """is `domain`, a parent of it, or one of its subdomains in the trie?"""
+    node = trie
+    for label in reversed(domain.split(".")):
+        node = node.get(label)
+        if node is None:
+            return False
+        if "$" in node:
+            return True
+    # we ran out of labels inside the trie, so something underneath
+    # `domain` is in there.
+    return True
+
+
 def compare(
-    mine: dict[str, dict], theirs: dict[str, dict], allow: list[str]
+    mine: dict[str, dict], theirs: dict[str, dict], allow: frozenset[str]
 ) -> dict[str, dict]:
     """find what we haven't added yet
 
@@ -123,50 +320,80 @@ def compare(
     be shorter than we expect (e.g. foo.example.com vs example.com)
     """
     logging.info("Generating differences")
-    missing = {}
-    for key in theirs.keys():
-        if key in allow:
-            logging.info(f"skipping allowed {key}")
-            continue
-        use = True
-        for mkey in mine:
-            if key.endswith(mkey) or mkey.endswith(key):
-                if mkey != key:
-                    logging.debug(f"{mkey} == {key}")
-                use = False
-                break
-        if use:
+    if not mine:
+        # nothing to compare against (e.g. a new instance), so
+        # everything that isn't allowed is missing.
+        if not allow:
+            missing = dict(theirs)
+        else:
+            missing = {k: v for k, v in theirs.items() if k not in allow}
+    else:
+        missing = {}
+        trie = _domain_trie(mine)
+        for key in theirs.keys():
+            if key in allow:
+                logging.info("skipping allowed %s", key)
+                continue
+            if _covered_by(trie, key):
+                if key not in mine:
+                    logging.debug("%s already covered", key)
+                continue
             missing[key] = theirs[key]
-            logging.debug(f"++ {key}")
+            logging.debug("++ %s", key)
     logging.info(f"Found {len(missing)} new sites")
     logging.debug(missing)
     return missing
 
 
-def apply_diff(home: str, auth: str, diff: dict[str, dict]):
-    """Add the domains we've not seen yet to our instance."""
+def _post_block(url: str, headers: dict, key: str, data: dict) -> tuple[str, int, str]:
+    """POST a single domain block to the home instance"""
+    pairs = [("domain", key), ("severity", data.get("severity", "suspend"))]
+    private_comment = data.get("private_comment")
+    if private_comment:
+        pairs.append(("private_comment", private_comment))
+    comment = data.get("comment")
+    if comment:
+        pairs.append(("comment", comment))
+    body = urlencode(pairs)
+    logging.debug(body)
+    resp = SESSION.post(url=url, headers=headers, data=body)
+    return key, resp.status_code, resp.text
+
+
+def apply_diff(
+    home: str, auth: str, diff: dict[str, dict], workers: int = APPLY_WORKERS
+):
+    """Add the domains we've not seen yet to our instance.
+
+    The blocks don't depend on each other, so they're POSTed
+    concurrently, at most `workers` at a time. The home instance gets
+    its own connection pool of the same size, so every worker keeps
+    its connection alive instead of the pool discarding the extras.
+    """
     logging.info("Applying differences to home site")
     url = f"https://{home}/api/v1/admin/domain_blocks"
-    creds = f"Bearer {auth}"
-    for key in diff.keys():
-        data = diff.get(key)
-        args = {
-            "domain": key,
-            "severity": data.get("severity", "suspend"),
-            "private_comment": data.get("private_comment"),
-        }
-        if diff.get(key).get("comment"):
-            args["comment"] = diff.get(key).get("comment")
-        body = urlencode(args)
-        logging.debug(body)
-        resp = requests.post(url=url, headers={"Authorization": creds}, data=body)
-        if resp.status_code == 422:
-            logging.warning(resp.text)
-            continue
-        if resp.status_code != 200:
-            raise Exception(
-                "Error updating blocks: {}:{}".format(resp.status_code, resp.text)
-            )
+    _mount_home(home, workers)
+    # Only sent to the home instance, so not set on the shared SESSION.
+    headers = {"Authorization": f"Bearer {auth}"}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_post_block, url, headers, key, data)
+            for key, data in diff.items()
+        ]
+        try:
+            for future in futures:
+                key, status, text = future.result()
+                if status == 422:
+                    logging.warning(text)
+                    continue
+                if status != 200:
+                    raise Exception(
+                        "Error updating blocks: {}:{}".format(status, text)
+                    )
+        except Exception:
+            # Don't keep hammering the server with the remaining blocks.
+            executor.shutdown(cancel_futures=True)
+            raise
     logging.info("Changes applied.")
 
 
@@ -185,28 +412,43 @@ def get_log_level(args) -> int:
     return result
 
 
-def dump_csv(f: FileIO, sites_data: dict[str, dict], allow: list):
-    """Dump the list as a Mastodon 4.1 compatible CSV.
-
-    The `private_comment` may not import, but will show the origin of the block.
-    """
-    f.write(
-        "#domain,#severity,#reject_media,#reject_reports,#public_comment,#obfuscate\n"
-    )
-    for site, data in sorted(sites_data.items(), key=lambda t: t[0]):
+def _csv_rows(sites_data: dict[str, dict], allow: frozenset[str]):
+    """yield the CSV rows for each non-allowed site, sorted by domain"""
+    for site, data in sorted(sites_data.items(), key=itemgetter(0)):
         if site in allow:
-            logging.info(f"skipping allowed {site}")
+            logging.info("skipping allowed %s", site)
             continue
         severity = data.get("severity") or "silence"
-        row = [
+        yield [
             site,
-            data.get("severity") or "silence",
+            severity,
             data.get("reject_media") or "{}".format(severity == "suspend").lower(),
             data.get("reject_report") or "{}".format(severity == "suspend").lower(),
-            '"{}"'.format(re.sub("([\"'])", r"\\\1", data.get("comment") or "")),
+            data.get("comment") or "",
             "false",
         ]
-        f.write(",".join(row) + "\n")
+
+
+def dump_csv(f: FileIO, sites_data: dict[str, dict], allow: frozenset[str]):
+    """Dump the list as a Mastodon 4.1 compatible CSV.
+
+    The `private_comment` may not import, but will show the origin of the block.
+    The rows are built in memory and written to `f` in one go.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    writer.writerow(
+        [
+            "#domain",
+            "#severity",
+            "#reject_media",
+            "#reject_reports",
+            "#public_comment",
+            "#obfuscate",
+        ]
+    )
+    writer.writerows(_csv_rows(sites_data, allow))
+    f.write(buffer.getvalue())
 
 
 def main():
@@ -215,29 +457,36 @@ def main():
     logging.basicConfig(encoding="utf-8", level=level)
     my_data = {}
     logging.info("Collecting public block lists")
-    sites_data = fetch(args.remote)
-    allow = []
+    sites_data = fetch(args.remote, args.cache_dir)
+    allow = frozenset()
     if args.allow:
         try:
             with open(args.allow, "r") as f:
-                allow = [x.strip() for x in f.read().split("\n")]
+                lines = (x.strip() for x in f)
+                allow = frozenset(
+                    _canonical_domain(x)
+                    for x in lines
+                    if x and not x.startswith("#")
+                )
         except FileNotFoundError as e:
             pass
     if args.output:
         logging.info(f"Outputing collected blocks to {args.output}")
-        with open(args.output, "w") as f:
+        with open(args.output, "w", newline="") as f:
             dump_csv(f, sites_data, allow)
     if args.home:
-        my_data = fetch([args.home])
+        # mount the home pool first, so the POSTs reuse this connection.
+        _mount_home(args.home, args.workers)
+        my_data = fetch([args.home], args.cache_dir)
         diff = compare(my_data, sites_data, allow)
         if not args.dry_run:
             if not args.app_key:
                 raise Exception(
                     "Missing `app_key` argument. Can't update home instance."
                 )
-            apply_diff(args.home, args.app_key, diff)
+            apply_diff(args.home, args.app_key, diff, args.workers)
     if args.dry_run:
-        print(json.dumps(diff, indent=2))
+        print(orjson.dumps(diff, option=orjson.OPT_INDENT_2).decode())
 
 
 main()